@@ -5,14 +5,24 @@ A robust tool for downloading media from Telegram channels and groups.
 """
 
 import asyncio
+import atexit
+import hashlib
 import json
 import logging
+import logging.handlers
+import math
 import os
+import queue
+import sqlite3
+import struct
 import sys
-import io
+import threading
+import time
+from contextlib import contextmanager
 from datetime import datetime
+from operator import attrgetter
 from pathlib import Path
-from typing import Dict, List, Optional, Set, Union
+from typing import AsyncIterator, Callable, Dict, List, Optional, Set, Tuple, Union
 
 import click
 from dotenv import load_dotenv
@@ -20,8 +30,8 @@ from rich.console import Console
 from rich.progress import Progress, SpinnerColumn, TextColumn, BarColumn, TaskProgressColumn, TimeRemainingColumn
 from rich.table import Table
 from rich.panel import Panel
-from tenacity import retry, stop_after_attempt, wait_exponential
 from telethon import TelegramClient
+from telethon.network import ConnectionTcpAbridged
 from telethon.errors import (
     FloodWaitError, 
     SessionPasswordNeededError, 
@@ -41,71 +51,412 @@ from link_extractor import TelegramLinkExtractor
 # Load environment variables
 load_dotenv()
 
-# Replace sys.stdout with a UTF-8 writer
-sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8')
+# Write UTF-8 to stdout, keeping the existing stream and its line buffering
+if hasattr(sys.stdout, 'reconfigure'):
+    sys.stdout.reconfigure(encoding='utf-8', line_buffering=True)
 
-# Configure logging
+# Configure logging. Records are formatted by the QueueHandler on the calling
+# thread and written by a background listener, so logging from the download
+# path never blocks the event loop on file or console I/O.
+_log_queue: queue.Queue = queue.Queue(-1)
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('telegram_downloader.log', encoding='utf-8'),
-        logging.StreamHandler(sys.stdout)
-    ]
+    handlers=[logging.handlers.QueueHandler(_log_queue)]
 )
+_log_listener = logging.handlers.QueueListener(
+    _log_queue,
+    logging.FileHandler('telegram_downloader.log', encoding='utf-8', delay=True),
+    logging.StreamHandler(sys.stdout)
+)
+_log_listener.start()
+atexit.register(_log_listener.stop)
 logger = logging.getLogger(__name__)
 
 # Rich console for better output
 console = Console()
 
+# Write buffer for downloaded files
+WRITE_BUFFER_SIZE = 4 * 1024 * 1024
+
+# Suffix for files that are still being downloaded; specific to this tool so
+# that clean_partial_files() never matches a real download such as "x.part"
+PARTIAL_SUFFIX = ".tmd-part"
+
+# Parallel chunk downloads: part size per request (Telethon's maximum) and
+# the smallest document worth splitting
+PARALLEL_PART_SIZE = 512 * 1024
+PARALLEL_MIN_SIZE = 10 * 1024 * 1024
+
+# Minimum seconds between progress bar updates for a single file
+PROGRESS_UPDATE_INTERVAL = 0.1
+
+# Server-side message filters for each media type; TL objects are immutable
+# requests, so one shared instance per type is enough
+MESSAGE_FILTERS = {
+    "images": InputMessagesFilterPhotos(),
+    "videos": InputMessagesFilterVideo(),
+    "documents": InputMessagesFilterDocument(),
+    "all": None
+}
+
+# Message attribute holding each media type, and the MIME type for the
+# document subtypes
+MEDIA_TYPE_ATTRIBUTES = {
+    "images": "photo",
+    "videos": "video",
+    "documents": "document",
+    "pdfs": "document",
+    "zips": "document",
+}
+MEDIA_TYPE_MIME_TYPES = {
+    "pdfs": "application/pdf",
+    "zips": "application/zip",
+}
+
+# Display names for the kinds returned by get_media_info()
+MEDIA_KIND_LABELS = {"video": "Video", "document": "Document", "photo": "Photo"}
+
+def _media_type_predicate(media_type: str) -> Callable[[Message], bool]:
+    """Build the message test for a media type from the two tables above."""
+    # Read only the one attribute this type needs
+    get_media = attrgetter(MEDIA_TYPE_ATTRIBUTES[media_type])
+    mime_type = MEDIA_TYPE_MIME_TYPES.get(media_type)
+    if mime_type is None:
+        return lambda message: get_media(message) is not None
+    return lambda message: getattr(get_media(message), 'mime_type', None) == mime_type
+
+# Message predicates for each media type, shared by streaming and list filtering
+MEDIA_TYPE_PREDICATES = {media_type: _media_type_predicate(media_type) for media_type in MEDIA_TYPE_ATTRIBUTES}
+
+class BloomFilter:
+    """Fixed-size Bloom filter over strings: never a false negative, false positives near error_rate up to capacity."""
+    
+    def __init__(self, capacity: int, error_rate: float = 1e-4):
+        self.capacity = max(1, capacity)
+        self.count = 0
+        self._size = math.ceil(-self.capacity * math.log(error_rate) / math.log(2) ** 2)
+        # One 32-bit index per hash, all sliced from a single blake2b digest
+        # (at most 64 bytes, hence at most 16 hashes)
+        self._hashes = min(16, max(1, round(self._size / self.capacity * math.log(2))))
+        self._unpack = struct.Struct(f"<{self._hashes}I").unpack
+        self._digest_size = 4 * self._hashes
+        self._bits = bytearray((self._size + 7) // 8)
+    
+    def _digest(self, key: str) -> tuple:
+        return self._unpack(hashlib.blake2b(key.encode('utf-8'), digest_size=self._digest_size).digest())
+    
+    def add(self, key: str):
+        bits = self._bits
+        size = self._size
+        for value in self._digest(key):
+            position = value % size
+            bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+    
+    def __contains__(self, key: str) -> bool:
+        bits = self._bits
+        size = self._size
+        # Misses usually stop at the first or second clear bit
+        for value in self._digest(key):
+            position = value % size
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
 class DownloadState:
     """Manages download state and resume functionality."""
     
-    def __init__(self, state_file: str = "download_state.json"):
+    # Completed downloads to accumulate before writing the state file mid-run
+    FLUSH_EVERY = 32
+    
+    # JSON state file used by earlier versions; imported once into a new database
+    LEGACY_STATE_FILE = "download_state.json"
+    
+    # Smallest Bloom filter to build; it is rebuilt at twice the size once full
+    BLOOM_MIN_CAPACITY = 10000
+    
+    def __init__(self, state_file: str = "download_state.db"):
         self.state_file = state_file
-        self.downloaded_files: Set[str] = set()
+        # The database is authoritative; only a Bloom filter of its IDs and the
+        # IDs not yet written to it are kept in memory
+        self._bloom = BloomFilter(self.BLOOM_MIN_CAPACITY)
+        # IDs marked while a larger filter is built in the background
+        self._marked_during_rebuild: Optional[List[str]] = None
+        self._unflushed: Set[str] = set()
+        self._pending: List[str] = []
+        self._conn: Optional[sqlite3.Connection] = None
+        self._db_lock = threading.Lock()
         self.load_state()
     
     def load_state(self):
-        """Load previously downloaded files from state file."""
+        """Open the state database and index previously downloaded files."""
         try:
-            if os.path.exists(self.state_file):
-                with open(self.state_file, 'r') as f:
-                    data = json.load(f)
-                    self.downloaded_files = set(data.get('downloaded_files', []))
-                logger.info(f"Loaded {len(self.downloaded_files)} previously downloaded files")
+            self._conn = sqlite3.connect(self.state_file, isolation_level=None, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS downloaded (file_id TEXT PRIMARY KEY)")
+            if not self._conn.execute("SELECT 1 FROM downloaded LIMIT 1").fetchone():
+                self._import_legacy_state()
+            self._bloom = self._build_bloom(list(self._unflushed))
+            logger.info(f"Loaded {self._bloom.count} previously downloaded files")
         except Exception as e:
             logger.warning(f"Could not load download state: {e}")
     
+    def _import_legacy_state(self):
+        """Carry over file IDs from a JSON state file written by earlier versions."""
+        if not os.path.exists(self.LEGACY_STATE_FILE):
+            return
+        with open(self.LEGACY_STATE_FILE, 'r') as f:
+            file_ids = json.load(f).get('downloaded_files', [])
+        self._write_state(file_ids)
+        logger.info(f"Imported download state from {self.LEGACY_STATE_FILE}")
+    
+    def _build_bloom(self, extra_ids: List[str]) -> BloomFilter:
+        """Build a Bloom filter over the database and extra_ids, with room to grow."""
+        # A separate read connection, so a background rebuild never holds _db_lock
+        conn = sqlite3.connect(self.state_file, check_same_thread=False)
+        try:
+            count = conn.execute("SELECT COUNT(*) FROM downloaded").fetchone()[0]
+            bloom = BloomFilter(max(self.BLOOM_MIN_CAPACITY, 2 * (count + len(extra_ids))))
+            for (file_id,) in conn.execute("SELECT file_id FROM downloaded"):
+                bloom.add(file_id)
+        finally:
+            conn.close()
+        for file_id in extra_ids:
+            bloom.add(file_id)
+        return bloom
+    
+    async def _grow_bloom(self):
+        """Replace the full Bloom filter with a larger one built in the executor."""
+        self._marked_during_rebuild = []
+        try:
+            loop = asyncio.get_running_loop()
+            bloom = await loop.run_in_executor(None, self._build_bloom, list(self._unflushed))
+            # IDs flushed during the scan may be missing from it
+            for file_id in self._marked_during_rebuild:
+                bloom.add(file_id)
+            self._bloom = bloom
+        except Exception as e:
+            # The old filter stays correct, only less selective
+            logger.warning(f"Could not grow download state filter: {e}")
+        finally:
+            self._marked_during_rebuild = None
+    
     def save_state(self):
-        """Save current download state to file."""
+        """Save pending download state to the database."""
+        file_ids = self._take_pending()
+        if self._write_state(file_ids):
+            self._unflushed.difference_update(file_ids)
+    
+    async def flush_state(self, min_pending: int = 1):
+        """Persist pending changes without blocking the event loop."""
+        if (self._bloom.count > self._bloom.capacity and self._marked_during_rebuild is None
+                and self._conn is not None):
+            await self._grow_bloom()
+        if len(self._pending) < min_pending:
+            return
+        file_ids = self._take_pending()
+        loop = asyncio.get_running_loop()
+        if await loop.run_in_executor(None, self._write_state, file_ids):
+            self._unflushed.difference_update(file_ids)
+    
+    def close(self):
+        """Save pending changes and close the state database."""
+        if self._conn is None:
+            return
+        self.save_state()
+        with self._db_lock:
+            # Closing the last connection checkpoints and removes the WAL
+            self._conn.close()
+            self._conn = None
+    
+    def _take_pending(self) -> List[str]:
+        """Hand over the file IDs marked since the last save."""
+        pending, self._pending = self._pending, []
+        return pending
+    
+    def _write_state(self, file_ids: List[str]) -> bool:
+        """Insert file IDs in a single transaction; returns whether they were stored."""
+        if not file_ids or self._conn is None:
+            return not file_ids
         try:
-            data = {
-                'downloaded_files': list(self.downloaded_files),
-                'last_updated': datetime.now().isoformat()
-            }
-            with open(self.state_file, 'w') as f:
-                json.dump(data, f, indent=2)
+            with self._db_lock:
+                self._conn.execute("BEGIN")
+                try:
+                    self._conn.executemany(
+                        "INSERT OR IGNORE INTO downloaded (file_id) VALUES (?)",
+                        ((file_id,) for file_id in file_ids)
+                    )
+                    self._conn.execute("COMMIT")
+                except Exception:
+                    self._conn.execute("ROLLBACK")
+                    raise
+            return True
         except Exception as e:
             logger.error(f"Could not save download state: {e}")
+            return False
     
     def is_downloaded(self, file_id: str) -> bool:
         """Check if a file has already been downloaded."""
-        return file_id in self.downloaded_files
+        # Most lookups on a new channel are misses, answered by the filter alone
+        if file_id not in self._bloom:
+            return False
+        if file_id in self._unflushed:
+            return True
+        if self._conn is None:
+            return False
+        with self._db_lock:
+            row = self._conn.execute(
+                "SELECT 1 FROM downloaded WHERE file_id = ? LIMIT 1", (file_id,)
+            ).fetchone()
+        return row is not None
     
     def mark_downloaded(self, file_id: str):
-        """Mark a file as downloaded."""
-        self.downloaded_files.add(file_id)
-        self.save_state()
+        """Mark a file as downloaded. Persisted on the next flush_state()."""
+        if file_id in self._unflushed:
+            return
+        self._unflushed.add(file_id)
+        self._pending.append(file_id)
+        self._bloom.add(file_id)
+        if self._marked_during_rebuild is not None:
+            self._marked_during_rebuild.append(file_id)
+
+# Rich allows one live display per console, so every downloader in the
+# process shares this one while any of their downloads are running
+_shared_progress: Optional[Progress] = None
+_shared_progress_users = 0
+
+@contextmanager
+def shared_progress():
+    """Yield the process-wide progress display, started on first use and stopped when the last user leaves."""
+    global _shared_progress, _shared_progress_users
+    if _shared_progress is None:
+        _shared_progress = Progress(
+            SpinnerColumn(),
+            TextColumn("[progress.description]{task.description}"),
+            BarColumn(),
+            TaskProgressColumn(),
+            TimeRemainingColumn(),
+            console=console,
+            transient=False,
+            refresh_per_second=10
+        )
+        _shared_progress.start()
+    _shared_progress_users += 1
+    try:
+        yield _shared_progress
+    finally:
+        _shared_progress_users -= 1
+        if _shared_progress_users == 0:
+            _shared_progress.stop()
+            _shared_progress = None
+
+def preallocate(f, size: int):
+    """Reserve disk space for a file about to be written, where the platform supports it."""
+    if size <= 0 or not hasattr(os, 'posix_fallocate'):
+        return
+    try:
+        os.posix_fallocate(f.fileno(), 0, size)
+    except OSError as e:
+        # Not every filesystem supports it; the download works either way
+        logger.debug(f"Could not preallocate {size} bytes: {e}")
+
+def get_photo_size(photo) -> int:
+    """Size in bytes of the largest variant of a photo, which is what download_media fetches."""
+    largest = 0
+    for size in getattr(photo, 'sizes', None) or []:
+        # PhotoSizeProgressive lists cumulative sizes; the last one is the full image
+        progressive = getattr(size, 'sizes', None)
+        if progressive:
+            value = progressive[-1]
+        else:
+            value = getattr(size, 'size', 0) or 0
+        largest = max(largest, value)
+    return largest
+
+def get_media_info(message: Message) -> Tuple[str, str, int, str]:
+    """Return (file_id, file_name, file_size, kind) from a single walk over the message media."""
+    cached = getattr(message, '_media_info_cache', None)
+    if cached is not None:
+        return cached
+    
+    message_id = getattr(message, 'id', 'unknown')
+    video = getattr(message, 'video', None)
+    document = getattr(message, 'document', None)
+    photo = getattr(message, 'photo', None)
+    
+    if video:
+        file_id, file_size, kind = f"video_{message_id}_{video.id}", video.size or 0, "video"
+    elif document:
+        file_id, file_size, kind = f"doc_{message_id}_{document.id}", document.size or 0, "document"
+    elif photo:
+        file_id, file_size, kind = f"photo_{message_id}_{photo.id}", get_photo_size(photo), "photo"
+    else:
+        file_id, file_size, kind = f"media_{message_id}", 0, "media"
+    
+    if document:
+        file_name = f"document_{message_id}"
+        for attr in getattr(document, 'attributes', []):
+            if isinstance(attr, DocumentAttributeFilename):
+                # Keep the default unless Telegram gave a usable name
+                if attr.file_name:
+                    file_name = attr.file_name if isinstance(attr.file_name, str) else str(attr.file_name)
+                break
+    elif video is not None:
+        file_name = f"video_{message_id}.mp4"
+    elif photo is not None:
+        file_name = f"photo_{message_id}.jpg"
+    else:
+        file_name = f"media_{message_id}"
+    
+    info = (file_id, file_name, file_size, kind)
+    try:
+        message._media_info_cache = info
+    except AttributeError:
+        pass
+    return info
+
+def has_file(message: Message) -> bool:
+    """Whether the message carries a photo or document that download_media can fetch."""
+    return get_media_info(message)[3] != "media"
+
+def create_client(session_name: str, api_id: int, api_hash: str) -> TelegramClient:
+    """Build a TelegramClient with the connection settings shared by every code path."""
+    return TelegramClient(
+        session_name,
+        api_id,
+        api_hash,
+        connection=ConnectionTcpAbridged,
+        use_ipv6=False,
+        # Telethon reconnects with these itself, including mid-session drops
+        auto_reconnect=True,
+        connection_retries=5,
+        retry_delay=2,
+        request_retries=5,
+        # Sleep through short FLOOD_WAITs instead of raising
+        flood_sleep_threshold=60
+    )
 
 class TelegramDownloader:
     """Enhanced Telegram media downloader with advanced features."""
     
-    def __init__(self, api_id: int, api_hash: str, session_name: str = "default_session"):
+    def __init__(
+        self,
+        api_id: int,
+        api_hash: str,
+        session_name: str = "default_session",
+        client: Optional[TelegramClient] = None,
+        parallel_chunks: int = 1
+    ):
         self.api_id = api_id
         self.api_hash = api_hash
         self.session_name = session_name
-        self.client: Optional[TelegramClient] = None
+        self.client: Optional[TelegramClient] = client
+        # A client passed in by the caller is theirs to disconnect
+        self._owns_client = client is None
+        # Concurrent streams per large document; >1 raises load on Telegram
+        self.parallel_chunks = max(1, parallel_chunks)
         self.download_state = DownloadState()
         
     async def __aenter__(self):
@@ -115,19 +466,16 @@ class TelegramDownloader:
     
     async def __aexit__(self, exc_type, exc_val, exc_tb):
         """Async context manager exit."""
-        if self.client:
+        self.close()
+        if self.client and self._owns_client:
             await self.client.disconnect()
     
-    @retry(
-        stop=stop_after_attempt(3),
-        wait=wait_exponential(multiplier=1, min=4, max=10),
-        reraise=True
-    )
     async def connect(self):
-        """Connect to Telegram with retry logic."""
+        """Connect to Telegram, prompting for credentials only if the session isn't authorized."""
         try:
-            self.client = TelegramClient(self.session_name, self.api_id, self.api_hash)
-            await self.client.start()
+            if self.client is None:
+                self.client = create_client(self.session_name, self.api_id, self.api_hash)
+            await self.client.connect()
             
             if not await self.client.is_user_authorized():
                 console.print("[red]Authentication required![/red]")
@@ -147,59 +495,33 @@ class TelegramDownloader:
             logger.error(f"Connection failed: {e}")
             raise
     
+    def _media_info(self, message: Message) -> Tuple[str, str, int, str]:
+        """Return (file_id, file_name, file_size, kind) from a single walk over the message media."""
+        return get_media_info(message)
+    
     def get_file_id(self, message: Message) -> str:
         """Generate a unique file ID for tracking downloads."""
-        if message.video:
-            return f"video_{message.id}_{message.video.id}"
-        elif message.document:
-            return f"doc_{message.id}_{message.document.id}"
-        elif message.photo:
-            return f"photo_{message.id}_{message.photo.id}"
-        else:
-            return f"media_{message.id}"
+        return self._media_info(message)[0]
     
     def get_file_name(self, message: Message) -> str:
         """Extract filename from message."""
-        document = getattr(message, 'document', None)
-        if document:
-            for attr in getattr(document, 'attributes', []):
-                if isinstance(attr, DocumentAttributeFilename):
-                    return attr.file_name
-            return f"document_{getattr(message, 'id', 'unknown')}"
-        video = getattr(message, 'video', None)
-        if video is not None:
-            return f"video_{getattr(message, 'id', 'unknown')}.mp4"
-        photo = getattr(message, 'photo', None)
-        if photo is not None:
-            return f"photo_{getattr(message, 'id', 'unknown')}.jpg"
-        return f"media_{getattr(message, 'id', 'unknown')}"
+        return self._media_info(message)[1]
     
     def get_file_size(self, message: Message) -> int:
         """Get file size in bytes."""
-        if message.video:
-            return message.video.size or 0
-        elif message.document:
-            return message.document.size or 0
-        elif message.photo:
-            return 1024 * 1024  # 1MB estimate
-        return 0
+        return self._media_info(message)[2]
     
     async def download_file(self, message: Message, folder_path: Path, progress: Progress) -> bool:
         """Download a single file with progress tracking and error handling."""
-        file_id = self.get_file_id(message)
-        file_name = self.get_file_name(message)
-        file_size = self.get_file_size(message)
-        
-        # Check if already downloaded
-        if self.download_state.is_downloaded(file_id):
-            logger.info(f"Skipping already downloaded file: {file_name}")
-            return True
-        
-        # Ensure file_name is a valid string (not an object)
-        if not isinstance(file_name, str) or file_name.startswith("<telethon.tl.custom"):
-            # Try to get from message.file.name or fallback
-            file_name = getattr(getattr(message, 'file', None), 'name', None) or f"media_{getattr(message, 'id', 'unknown')}"
+        file_id, file_name, file_size, kind = self._media_info(message)
+        assert isinstance(file_name, str)
+        if kind == "media":
+            # Polls, geo points, dice and previews without a photo or document
+            logger.info(f"Skipping message {getattr(message, 'id', 'unknown')}: no file to download")
+            return False
         file_path = folder_path / file_name
+        # Written under a temporary name so a file only appears once complete
+        part_path = file_path.with_name(file_path.name + PARTIAL_SUFFIX)
         
         # Create task for progress tracking
         task = progress.add_task(
@@ -208,12 +530,35 @@ class TelegramDownloader:
             filename=file_name
         )
         
+        last_update = 0.0
+        
+        def progress_callback(current, total):
+            # Rich re-renders on every update; cap it instead of firing per chunk
+            nonlocal last_update
+            now = time.monotonic()
+            if now - last_update >= PROGRESS_UPDATE_INTERVAL or current == total:
+                progress.update(task, completed=current)
+                last_update = now
+        
         try:
-            # Download with progress callback
-            await message.download_media(
-                file=str(file_path),
-                progress_callback=lambda current, total: progress.update(task, completed=current)
-            )
+            document = getattr(message, 'document', None)
+            if self.parallel_chunks > 1 and document and file_size >= PARALLEL_MIN_SIZE:
+                await self._download_parallel(document, part_path, file_size, progress_callback)
+            else:
+                # Download with progress callback, coalescing Telethon's small
+                # chunk writes into large sequential ones
+                with open(part_path, 'wb', buffering=WRITE_BUFFER_SIZE) as f:
+                    preallocate(f, file_size)
+                    result = await message.download_media(file=f, progress_callback=progress_callback)
+                    # Drop any preallocated space beyond what was written
+                    f.truncate()
+                if result is None:
+                    # Telethon found nothing it could fetch
+                    part_path.unlink()
+                    progress.update(task, description=f"[yellow]- No file in {file_name}")
+                    logger.warning(f"Nothing to download for {file_name}")
+                    return False
+            os.replace(part_path, file_path)
             
             # Mark as downloaded
             self.download_state.mark_downloaded(file_id)
@@ -224,11 +569,86 @@ class TelegramDownloader:
         except Exception as e:
             progress.update(task, description=f"[red]✗ Failed {file_name}")
             logger.error(f"Failed to download {file_name}: {e}")
-            # Remove partial file if it exists
-            if file_path.exists():
-                file_path.unlink()
+            # The partial file is left in place; see clean_partial_files()
             return False
     
+    def clean_partial_files(self, folder_path: Path) -> int:
+        """Remove partial files left behind by failed or interrupted downloads."""
+        removed = 0
+        for part_path in folder_path.glob(f"*{PARTIAL_SUFFIX}"):
+            try:
+                part_path.unlink()
+                removed += 1
+            except OSError as e:
+                logger.warning(f"Could not remove partial file {part_path}: {e}")
+        if removed:
+            logger.info(f"Removed {removed} partial files from {folder_path}")
+        return removed
+    
+    async def _download_parallel(self, document, file_path: Path, file_size: int, progress_callback):
+        """Fetch a document over several interleaved iter_download streams, writing each part at its offset."""
+        part_size = PARALLEL_PART_SIZE
+        streams = self.parallel_chunks
+        total_parts = (file_size + part_size - 1) // part_size
+        downloaded = 0
+        
+        with open(file_path, 'wb') as f:
+            preallocate(f, file_size)
+            f.truncate(file_size)
+            
+            async def fetch(index: int):
+                nonlocal downloaded
+                position = index * part_size
+                async for chunk in self.client.iter_download(
+                    document,
+                    offset=position,
+                    stride=streams * part_size,
+                    request_size=part_size,
+                    limit=(total_parts - index + streams - 1) // streams,
+                    file_size=file_size
+                ):
+                    # No await between seek and write, so streams can't interleave here
+                    f.seek(position)
+                    f.write(chunk)
+                    position += streams * part_size
+                    downloaded += len(chunk)
+                    progress_callback(downloaded, file_size)
+            
+            tasks = [asyncio.ensure_future(fetch(index)) for index in range(min(streams, total_parts))]
+            try:
+                done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+            finally:
+                # Stop the other streams before the file is closed under them
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+            for task in done:
+                # Re-raise the first stream failure, if any
+                task.result()
+    
+    async def iter_media_messages(
+        self, 
+        entity: Union[str, Channel, Chat], 
+        filter_type: Optional[object] = None,
+        limit: int = 2000,
+        offset_date: Optional[datetime] = None
+    ) -> AsyncIterator[Message]:
+        """Yield media messages as they are fetched from Telegram."""
+        # Get entity if string is provided
+        if isinstance(entity, str):
+            entity = await self.client.get_entity(entity)
+        
+        console.print(f"[yellow]Fetching messages from: {getattr(entity, 'title', entity)}[/yellow]")
+        
+        async for message in self.client.iter_messages(
+            entity, 
+            filter=filter_type, 
+            limit=limit,
+            offset_date=offset_date
+        ):
+            if message.media:
+                yield message
+    
     async def get_media_messages(
         self, 
         entity: Union[str, Channel, Chat], 
@@ -238,22 +658,9 @@ class TelegramDownloader:
     ) -> List[Message]:
         """Get media messages with filtering and pagination."""
         try:
-            # Get entity if string is provided
-            if isinstance(entity, str):
-                entity = await self.client.get_entity(entity)
-            
-            console.print(f"[yellow]Fetching messages from: {getattr(entity, 'title', entity)}[/yellow]")
-            
-            messages = []
-            async for message in self.client.iter_messages(
-                entity, 
-                filter=filter_type, 
-                limit=limit,
-                offset_date=offset_date
-            ):
-                if message.media:
-                    messages.append(message)
-            
+            messages = [
+                message async for message in self.iter_media_messages(entity, filter_type, limit, offset_date)
+            ]
             console.print(f"[green]Found {len(messages)} media messages[/green]")
             return messages
             
@@ -261,81 +668,159 @@ class TelegramDownloader:
             logger.error(f"Error fetching messages: {e}")
             raise
     
+    def close(self):
+        """Close the download state."""
+        self.download_state.close()
+    
     async def download_batch(
         self, 
         messages: List[Message], 
         folder_path: Path, 
         batch_size: int = 5
     ) -> Dict[str, int]:
-        """Download messages in batches with progress tracking."""
+        """Download messages concurrently with progress tracking."""
         stats = {"success": 0, "failed": 0, "skipped": 0}
         
+        # Messages without a photo or document have nothing to download
+        messages = [message for message in messages if has_file(message)]
+        
+        # Skip already downloaded files before any progress bookkeeping
+        pending = [
+            message for message in messages
+            if not self.download_state.is_downloaded(self.get_file_id(message))
+        ]
+        stats["skipped"] = len(messages) - len(pending)
+        if stats["skipped"]:
+            logger.info(f"Skipping {stats['skipped']} already downloaded files")
+        if not pending:
+            return stats
+        
         # Create download folder
         folder_path.mkdir(parents=True, exist_ok=True)
         
-        with Progress(
-            SpinnerColumn(),
-            TextColumn("[progress.description]{task.description}"),
-            BarColumn(),
-            TaskProgressColumn(),
-            TimeRemainingColumn(),
-            console=console
-        ) as progress:
-            
-            # Process in batches
-            for i in range(0, len(messages), batch_size):
-                batch = messages[i:i + batch_size]
-                console.print(f"\n[cyan]Processing batch {i//batch_size + 1}/{(len(messages) + batch_size - 1)//batch_size}[/cyan]")
-                
-                # Download files in parallel
-                tasks = [
-                    self.download_file(message, folder_path, progress) 
-                    for message in batch
-                ]
-                
-                results = await asyncio.gather(*tasks, return_exceptions=True)
-                
-                # Count results
-                for result in results:
-                    if isinstance(result, Exception):
-                        stats["failed"] += 1
-                        logger.error(f"Download task failed: {result}")
-                    elif result is True:
-                        stats["success"] += 1
-                    else:
-                        stats["skipped"] += 1
+        with shared_progress() as progress:
+            # Keep up to batch_size downloads in flight at all times, so one
+            # large file doesn't idle the other slots until a batch boundary
+            semaphore = asyncio.Semaphore(batch_size)
+            console.print(f"\n[cyan]Downloading {len(pending)} files, {batch_size} at a time[/cyan]")
+        
+            async def download_one(message: Message):
+                async with semaphore:
+                    try:
+                        result = await self.download_file(message, folder_path, progress)
+                    except Exception as e:
+                        result = e
+                await self.download_state.flush_state(min_pending=DownloadState.FLUSH_EVERY)
+                return result
+        
+            if hasattr(asyncio, 'TaskGroup'):
+                async with asyncio.TaskGroup() as tg:
+                    tasks = [tg.create_task(download_one(message)) for message in pending]
+                results = [task.result() for task in tasks]
+            else:
+                results = await asyncio.gather(*(download_one(message) for message in pending))
+        
+        await self.download_state.flush_state()
+        
+        # Count results
+        for result in results:
+            if isinstance(result, Exception):
+                stats["failed"] += 1
+                logger.error(f"Download task failed: {result}")
+            elif result is True:
+                stats["success"] += 1
+            else:
+                stats["failed"] += 1
+        
+        return stats
+    
+    async def _message_producer(
+        self,
+        entity: Union[str, Channel, Chat],
+        filter_type: Optional[object],
+        limit: int,
+        queue: asyncio.Queue,
+        workers: int,
+        media_type: str = "all",
+        stats: Optional[Dict[str, int]] = None
+    ):
+        """Feed media messages that still need downloading into the queue, then one sentinel per worker."""
+        predicate = MEDIA_TYPE_PREDICATES.get(media_type.lower())
+        async for message in self.iter_media_messages(entity, filter_type, limit):
+            if predicate is not None and not predicate(message):
+                continue
+            if not has_file(message):
+                continue
+            if self.download_state.is_downloaded(self.get_file_id(message)):
+                if stats is not None:
+                    stats["skipped"] += 1
+                continue
+            await queue.put(message)
+        # Only at the end of input; on errors the caller cancels the workers instead
+        for _ in range(workers):
+            await queue.put(None)
+    
+    async def _download_worker(self, queue: asyncio.Queue, folder_path: Path, progress: Progress, stats: Dict[str, int]):
+        """Download queued messages until a sentinel is received."""
+        while True:
+            message = await queue.get()
+            if message is None:
+                return
+            try:
+                result = await self.download_file(message, folder_path, progress)
+            except Exception as e:
+                logger.error(f"Download task failed: {e}")
+                result = False
+            stats["success" if result is True else "failed"] += 1
+            await self.download_state.flush_state(min_pending=DownloadState.FLUSH_EVERY)
+    
+    async def download_from_channel(
+        self,
+        entity: Union[str, Channel, Chat],
+        folder_path: Path,
+        filter_type: Optional[object] = None,
+        limit: int = 2000,
+        batch_size: int = 5,
+        media_type: str = "all"
+    ) -> Dict[str, int]:
+        """Download media while messages are still being fetched, without holding the whole history in memory."""
+        stats = {"success": 0, "failed": 0, "skipped": 0}
+        
+        # Create download folder
+        folder_path.mkdir(parents=True, exist_ok=True)
+        
+        # Bounded so fetching pauses while the workers are busy
+        queue: asyncio.Queue = asyncio.Queue(maxsize=batch_size * 4)
+        
+        with shared_progress() as progress:
+            console.print(f"\n[cyan]Downloading up to {batch_size} files at a time[/cyan]")
+        
+            workers = [
+                asyncio.ensure_future(self._download_worker(queue, folder_path, progress, stats))
+                for _ in range(batch_size)
+            ]
+            try:
+                await self._message_producer(entity, filter_type, limit, queue, batch_size, media_type, stats)
+                # Let queued and in-flight downloads finish
+                await asyncio.gather(*workers)
+            except BaseException:
+                # Cancelled or fetching failed: stop now rather than draining the queue
+                for worker in workers:
+                    worker.cancel()
+                await asyncio.gather(*workers, return_exceptions=True)
+                raise
+            finally:
+                await self.download_state.flush_state()
         
         return stats
     
     def get_filter_type(self, media_type: str):
         """Get Telethon filter type based on media type."""
-        filters = {
-            "images": InputMessagesFilterPhotos(),
-            "videos": InputMessagesFilterVideo(),
-            "documents": InputMessagesFilterDocument(),
-            "all": None
-        }
-        return filters.get(media_type.lower())
+        return get_filter_type(media_type)
     
     def filter_messages_by_type(self, messages: List[Message], media_type: str) -> List[Message]:
         """Filter messages by specific media type."""
-        if media_type.lower() == "all":
-            return messages
-        
-        filtered = []
-        for message in messages:
-            if media_type.lower() == "images" and message.photo:
-                filtered.append(message)
-            elif media_type.lower() == "videos" and message.video:
-                filtered.append(message)
-            elif media_type.lower() == "pdfs" and message.document and message.document.mime_type == "application/pdf":
-                filtered.append(message)
-            elif media_type.lower() == "zips" and message.document and message.document.mime_type == "application/zip":
-                filtered.append(message)
-            elif media_type.lower() == "documents" and message.document:
-                filtered.append(message)
-        
-        return filtered
+        return filter_messages_by_type(messages, media_type)
 
 # --- Main Menu Logic ---
 def main_menu():
@@ -368,7 +853,10 @@ def main_menu():
 @click.option('--resume', is_flag=True, help='Resume from previous download state')
 @click.option('--extract-links', is_flag=True, help='Extract Telegram channel links from messages and save to JSON')
 @click.option('--extract-output', default=None, help='Output file for extracted links (JSON)')
-def main(channel, media_type, limit, batch_size, output, dry_run, resume, extract_links, extract_output):
+@click.option('--parallel-chunks', default=None, help='Parallel connections per large document (default 1)')
+@click.option('--clean-partials', is_flag=True, help='Delete partial (.tmd-part) files left by earlier failed downloads')
+@click.option('--pretty-links', is_flag=True, help='Write the extracted links JSON indented for reading')
+def main(channel, media_type, limit, batch_size, output, dry_run, resume, extract_links, extract_output, parallel_chunks, clean_partials, pretty_links):
     api_id = os.getenv("API_ID")
     api_hash = os.getenv("API_HASH")
     if not api_id or not api_hash:
@@ -402,46 +890,33 @@ def main(channel, media_type, limit, batch_size, output, dry_run, resume, extrac
         else:
             sys.exit(0)
 
-    asyncio.run(run_main(api_id, api_hash, channel, media_type, limit, batch_size, output, dry_run, resume, extract_links, extract_output))
+    asyncio.run(run_main(api_id, api_hash, channel, media_type, limit, batch_size, output, dry_run, resume, extract_links, extract_output, parallel_chunks, clean_partials, pretty_links))
 
-async def run_main(api_id, api_hash, channel, media_type, limit, batch_size, output, dry_run, resume, extract_links, extract_output):
+async def run_main(api_id, api_hash, channel, media_type, limit, batch_size, output, dry_run, resume, extract_links, extract_output, parallel_chunks=None, clean_partials=False, pretty_links=False):
     # Only one TelegramClient instance, used everywhere
-    async with TelegramClient("default_session", api_id, api_hash) as client:
+    async with create_client("default_session", api_id, api_hash) as client:
         if extract_links:
-            await run_link_extraction(client, channel, limit, extract_output)
+            await run_link_extraction(client, channel, limit, extract_output, pretty_links)
         else:
-            await run_media_download(client, channel, media_type, limit, batch_size, output, dry_run, resume)
+            await run_media_download(client, channel, media_type, limit, batch_size, output, dry_run, resume, parallel_chunks, clean_partials)
 
 def get_filter_type(media_type: str):
-    filters = {
-        "images": InputMessagesFilterPhotos(),
-        "videos": InputMessagesFilterVideo(),
-        "documents": InputMessagesFilterDocument(),
-        "all": None
-    }
-    return filters.get(media_type.lower())
+    return MESSAGE_FILTERS.get(media_type.lower())
 
 def filter_messages_by_type(messages, media_type: str):
-    if media_type.lower() == "all":
+    media_type = media_type.lower()
+    if media_type == "all":
         return messages
-    filtered = []
-    for message in messages:
-        if media_type.lower() == "images" and getattr(message, 'photo', None):
-            filtered.append(message)
-        elif media_type.lower() == "videos" and getattr(message, 'video', None):
-            filtered.append(message)
-        elif media_type.lower() == "pdfs" and getattr(message, 'document', None) and getattr(message.document, 'mime_type', None) == "application/pdf":
-            filtered.append(message)
-        elif media_type.lower() == "zips" and getattr(message, 'document', None) and getattr(message.document, 'mime_type', None) == "application/zip":
-            filtered.append(message)
-        elif media_type.lower() == "documents" and getattr(message, 'document', None):
-            filtered.append(message)
-    return filtered
-
-async def run_media_download(client, channel, media_type, limit, batch_size, output, dry_run, resume):
+    predicate = MEDIA_TYPE_PREDICATES.get(media_type)
+    if predicate is None:
+        return []
+    return list(filter(predicate, messages))
+
+async def run_media_download(client, channel, media_type, limit, batch_size, output, dry_run, resume, parallel_chunks=None, clean_partials=False):
     # Set defaults if not provided
     media_type = media_type or "all"
     batch_size = int(batch_size) if batch_size else 5
+    parallel_chunks = int(parallel_chunks) if parallel_chunks else 1
     limit = int(limit) if limit else 2000
     output = output or "downloads"
     # Show configuration
@@ -452,35 +927,37 @@ async def run_media_download(client, channel, media_type, limit, batch_size, out
     table.add_row("Media Type", media_type)
     table.add_row("Limit", str(limit))
     table.add_row("Batch Size", str(batch_size))
+    table.add_row("Parallel Chunks", str(parallel_chunks))
     table.add_row("Output Directory", output)
     table.add_row("Dry Run", str(dry_run))
     table.add_row("Resume", str(resume))
     console.print(table)
     if dry_run:
         console.print("[yellow]Dry run mode - no files will be downloaded[/yellow]")
-    # Get media messages
     filter_type = get_filter_type(media_type)
-    messages = []
-    async for msg in client.iter_messages(channel, filter=filter_type, limit=limit):
-        messages.append(msg)
-    if not messages:
-        console.print("[red]No media messages found![/red]")
-        return
-    if media_type in ['pdfs', 'zips']:
-        messages = filter_messages_by_type(messages, media_type)
     if dry_run:
+        # Get media messages
+        messages = []
+        async for msg in client.iter_messages(channel, filter=filter_type, limit=limit):
+            messages.append(msg)
+        if not messages:
+            console.print("[red]No media messages found![/red]")
+            return
+        if media_type in ['pdfs', 'zips']:
+            messages = filter_messages_by_type(messages, media_type)
         table = Table(title="Files to be downloaded")
         table.add_column("ID", style="cyan")
         table.add_column("Type", style="yellow")
         table.add_column("Size", style="green")
         table.add_column("Name", style="white")
+        # One media walk per message, for both the preview rows and the total
         total_size = 0
-        for msg in messages[:10]:
-            file_name = getattr(msg, 'file', None) or getattr(msg, 'id', None)
-            file_size = getattr(getattr(msg, 'document', None), 'size', 0) or getattr(getattr(msg, 'video', None), 'size', 0) or 0
+        for index, msg in enumerate(messages):
+            _, file_name, file_size, kind = get_media_info(msg)
             total_size += file_size
-            msg_type = "Video" if getattr(msg, 'video', None) else "Document" if getattr(msg, 'document', None) else "Photo" if getattr(msg, 'photo', None) else "Other"
-            table.add_row(str(msg.id), msg_type, f"{file_size/1024/1024:.1f}MB", str(file_name))
+            if index < 10:
+                msg_type = MEDIA_KIND_LABELS.get(kind, "Other")
+                table.add_row(str(msg.id), msg_type, f"{file_size/1024/1024:.1f}MB", file_name)
         if len(messages) > 10:
             table.add_row("...", "...", "...", f"... and {len(messages)-10} more files")
         console.print(table)
@@ -491,10 +968,23 @@ async def run_media_download(client, channel, media_type, limit, batch_size, out
     if not output_path.exists():
         output_path.mkdir(parents=True, exist_ok=True)
     console.print(f"\n[cyan]Starting download to: {output_path}[/cyan]")
-    # Use TelegramDownloader for graphical progress
-    downloader = TelegramDownloader(api_id=client.api_id, api_hash=client.api_hash, session_name=client.session.filename)
-    downloader.client = client  # Use the already-authenticated client
-    stats = await downloader.download_batch(messages, output_path, batch_size=batch_size)
+    # Use TelegramDownloader for graphical progress, on the already-authenticated client
+    downloader = TelegramDownloader(
+        api_id=client.api_id, api_hash=client.api_hash, session_name=client.session.filename, client=client,
+        parallel_chunks=parallel_chunks
+    )
+    if clean_partials:
+        downloader.clean_partial_files(output_path)
+    # Stream messages straight into the download workers
+    try:
+        stats = await downloader.download_from_channel(
+            channel, output_path, filter_type=filter_type, limit=limit, batch_size=batch_size, media_type=media_type
+        )
+    finally:
+        downloader.close()
+    if not sum(stats.values()):
+        console.print("[red]No media messages found![/red]")
+        return
     # Show results
     result_table = Table(title="Download Results")
     result_table.add_column("Metric", style="cyan")
@@ -507,14 +997,15 @@ async def run_media_download(client, channel, media_type, limit, batch_size, out
     if stats["failed"] > 0:
         console.print("[yellow]Some downloads failed. Check the log file for details.[/yellow]")
 
-async def run_link_extraction(client, channel, limit, extract_output):
+async def run_link_extraction(client, channel, limit, extract_output, pretty=False):
     extractor = TelegramLinkExtractor(client)
     console.print(f"[yellow]Extracting links from {channel}...[/yellow]")
     results = await extractor.extract_links_from_channel(
         channel_identifier=channel,
         limit=int(limit) if limit else 1000,
         save_to_file=True,
-        output_file=extract_output or "extracted_links.json"
+        output_file=extract_output or "extracted_links.json",
+        pretty=pretty
     )
     console.print(f"[green]Extraction complete! {results['extraction_info']['total_links_found']} links found.[/green]")
     console.print(f"[green]Links saved to: {extract_output or 'extracted_links.json'}[/green]")
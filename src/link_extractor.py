@@ -3,87 +3,197 @@ Telegram Link Extractor Module
 Extracts channel links from Telegram messages and stores detailed information.
 """
 
-import json
+import asyncio
+import os
 import re
 import logging
+from collections import Counter, OrderedDict
+from dataclasses import dataclass
 from datetime import datetime
+from itertools import chain
 from pathlib import Path
-from typing import Dict, List, Optional, Any
+from typing import Dict, List, Optional, Any, Tuple
 
 from telethon.tl.types import Message, MessageEntityTextUrl, MessageEntityUrl, KeyboardButtonUrl
 from telethon.tl.functions.channels import GetFullChannelRequest
+from telethon.helpers import add_surrogate, del_surrogate
+
+from utils import dumps
 
 logger = logging.getLogger(__name__)
 
+# Messages buffered ahead of extraction, and processed per executor call
+MESSAGE_QUEUE_SIZE = 200
+EXTRACT_BATCH_SIZE = 100
+# Channels whose entity and info are kept between lookups
+CHANNEL_CACHE_SIZE = 256
+
+# Telegram link formats. All t.me forms share one prefix so the engine
+# matches it once per position instead of once per alternative. Telegram
+# writes the scheme and domain in lowercase, so no IGNORECASE is needed.
+_TME_RE = re.compile(r'(?:https?://)?t\.me/(?:joinchat/[A-Za-z0-9_-]+|c/\d+/\d+|[A-Za-z0-9_]+)')
+# @username mentions; the lookbehind stops matches inside e-mail addresses
+_MENTION_RE = re.compile(r'(?<![A-Za-z0-9_])@[A-Za-z0-9_]{5,32}\b')
+
+@dataclass
+class LinkHit:
+    """A link found in a message; converted to a dict only when saved."""
+    # Declared by hand (not slots=True) to keep Python 3.8 support
+    __slots__ = ('link', 'message_id', 'chat_id', 'context', 'position', 'timestamp')
+    link: str
+    message_id: int
+    chat_id: Optional[int]
+    context: str
+    position: Optional[Tuple[int, int]]
+    timestamp: str
+
+class LinkStreamWriter:
+    """Writes a results file incrementally: each link as it is found, the summary sections at the end."""
+
+    def __init__(self, output_file: str, pretty: bool = False):
+        self.output_path = Path(output_file)
+        self.output_path.parent.mkdir(parents=True, exist_ok=True)
+        self.pretty = pretty
+        # Pretty output is laid out as json.dump(indent=2) would write it
+        self._newline = b'\n' if pretty else b''
+        self._indent = b'  ' if pretty else b''
+        # Written under a temporary name so a failed run never leaves a truncated file
+        self._part_path = self.output_path.with_name(self.output_path.name + '.part')
+        self._file = open(self._part_path, 'wb')
+        self._file.write(b'{' + self._newline + self._indent + self._member(b'"links"') + b'[')
+        self._empty = True
+
+    def _member(self, key: bytes) -> bytes:
+        return key + (b': ' if self.pretty else b':')
+
+    def _nested(self, value: Any, depth: int) -> bytes:
+        return dumps(value, self.pretty).replace(b'\n', self._newline + self._indent * depth)
+
+    def write(self, link: LinkHit):
+        if not self._empty:
+            self._file.write(b',')
+        self._file.write(self._newline + self._indent * 2 + self._nested(link, 2))
+        self._empty = False
+
+    def close(self, sections: Dict[str, Any]):
+        """Finish the links array, append the remaining sections and move the file into place."""
+        if not self._empty:
+            self._file.write(self._newline + self._indent)
+        self._file.write(b']')
+        for key, value in sections.items():
+            self._file.write(b',' + self._newline + self._indent + self._member(dumps(key)) + self._nested(value, 1))
+        self._file.write(self._newline + b'}\n')
+        self._file.close()
+        os.replace(self._part_path, self.output_path)
+        logger.info(f"Links saved to: {self.output_path}")
+
+    def abort(self):
+        """Discard the partial file."""
+        self._file.close()
+        try:
+            self._part_path.unlink()
+        except OSError:
+            pass
+
 class TelegramLinkExtractor:
     """Extracts and analyzes Telegram channel links from messages."""
     def __init__(self, client):
         self.client = client
-        # Improved regex patterns for all Telegram link formats
-        self.link_patterns = [
-            r'https?://t\.me/[a-zA-Z0-9_]+',
-            r't\.me/[a-zA-Z0-9_]+',
-            r'@([a-zA-Z0-9_]{5,32})',
-            r'https?://t\.me/joinchat/[a-zA-Z0-9_-]+',
-            r'https?://t\.me/c/\d+/\d+',
-        ]
-
-    def extract_links_from_text(self, text: str, message_id: int, chat_id: Optional[int], context: str = "") -> List[Dict[str, Any]]:
+        # Keyed on the normalized identifier; see _cache_key
+        self._entity_cache: OrderedDict = OrderedDict()
+        self._channel_info_cache: OrderedDict = OrderedDict()
+        self._lookup_locks: Dict[Tuple[str, str], asyncio.Lock] = {}
+
+    @staticmethod
+    def _cache_key(channel_identifier: str) -> str:
+        return channel_identifier.lstrip('@').lower()
+
+    async def _cached_lookup(self, cache: OrderedDict, kind: str, key: str, fetch):
+        """Return cache[key], awaiting fetch() once on a miss even when callers race."""
+        if key in cache:
+            cache.move_to_end(key)
+            return cache[key]
+        lock = self._lookup_locks.setdefault((kind, key), asyncio.Lock())
+        async with lock:
+            if key in cache:
+                return cache[key]
+            try:
+                value = await fetch()
+            finally:
+                self._lookup_locks.pop((kind, key), None)
+            # Failed lookups are retried next time
+            if value is not None:
+                cache[key] = value
+                if len(cache) > CHANNEL_CACHE_SIZE:
+                    cache.popitem(last=False)
+            return value
+
+    async def get_entity(self, channel_identifier: str):
+        return await self._cached_lookup(
+            self._entity_cache, 'entity', self._cache_key(channel_identifier),
+            lambda: self.client.get_entity(channel_identifier),
+        )
+
+    def extract_links_from_text(self, text: str, message_id: int, chat_id: Optional[int], context: str = "", timestamp: Optional[str] = None) -> List[LinkHit]:
         links = []
         if not text:
             return links
-        for pattern in self.link_patterns:
-            matches = re.finditer(pattern, text, re.IGNORECASE)
-            for match in matches:
-                link = match.group(0)
-                links.append({
-                    'link': link,
-                    'message_id': message_id,
-                    'chat_id': chat_id,
-                    'context': context,
-                    'position': match.span(),
-                    'timestamp': datetime.now().isoformat()
-                })
+        # Most messages have no links; a substring check rules them out far
+        # faster than running the regexes over the whole text
+        if '@' not in text and 't.me' not in text:
+            return links
+        timestamp = timestamp or datetime.now().isoformat()
+        for match in chain(_TME_RE.finditer(text), _MENTION_RE.finditer(text)):
+            links.append(LinkHit(match.group(0), message_id, chat_id, context, match.span(), timestamp))
         return links
 
-    def extract_links_from_entities(self, message: Message) -> List[Dict[str, Any]]:
+    def extract_links_from_entities(self, message: Message, message_id: int, chat_id: Optional[int], timestamp: Optional[str] = None) -> List[LinkHit]:
         links = []
         if hasattr(message, 'entities') and message.entities:
+            timestamp = timestamp or datetime.now().isoformat()
+            surrogate_text = None
             for entity in message.entities:
-                if isinstance(entity, (MessageEntityTextUrl, MessageEntityUrl)):
-                    if hasattr(entity, 'url') and entity.url:
-                        links.append({
-                            'link': entity.url,
-                            'message_id': message.id,
-                            'chat_id': getattr(message, 'chat_id', None),
-                            'context': 'entity',
-                            'position': (entity.offset, entity.offset + entity.length),
-                            'timestamp': datetime.now().isoformat()
-                        })
+                entity_type = type(entity)
+                if entity_type is MessageEntityTextUrl:
+                    url = entity.url
+                elif entity_type is MessageEntityUrl:
+                    # The URL is the entity's span of the text; offsets count UTF-16 units
+                    if surrogate_text is None:
+                        surrogate_text = add_surrogate(getattr(message, 'message', None) or '')
+                    url = del_surrogate(surrogate_text[entity.offset:entity.offset + entity.length])
+                else:
+                    continue
+                if url:
+                    links.append(LinkHit(
+                        url, message_id, chat_id, 'entity',
+                        (entity.offset, entity.offset + entity.length), timestamp
+                    ))
         return links
 
-    def extract_links_from_reply_markup(self, message: Message) -> List[Dict[str, Any]]:
+    def extract_links_from_reply_markup(self, message: Message, message_id: int, chat_id: Optional[int], timestamp: Optional[str] = None) -> List[LinkHit]:
         links = []
         markup = getattr(message, 'reply_markup', None)
         if markup and hasattr(markup, 'rows'):
+            timestamp = timestamp or datetime.now().isoformat()
             for row in markup.rows:
                 for button in row.buttons:
                     if isinstance(button, KeyboardButtonUrl):
-                        links.append({
-                            'link': button.url,
-                            'message_id': message.id,
-                            'chat_id': getattr(message, 'chat_id', None),
-                            'context': 'button',
-                            'position': None,
-                            'timestamp': datetime.now().isoformat()
-                        })
+                        links.append(LinkHit(
+                            button.url, message_id, chat_id, 'button', None, timestamp
+                        ))
         return links
 
     async def get_channel_info(self, channel_identifier: str) -> Optional[Dict[str, Any]]:
+        if channel_identifier.startswith('@'):
+            channel_identifier = channel_identifier[1:]
+        return await self._cached_lookup(
+            self._channel_info_cache, 'channel_info', self._cache_key(channel_identifier),
+            lambda: self._fetch_channel_info(channel_identifier),
+        )
+
+    async def _fetch_channel_info(self, channel_identifier: str) -> Optional[Dict[str, Any]]:
         try:
-            if channel_identifier.startswith('@'):
-                channel_identifier = channel_identifier[1:]
-            entity = await self.client.get_entity(channel_identifier)
+            entity = await self.get_entity(channel_identifier)
             if not entity:
                 return None
             if hasattr(entity, 'id'):
@@ -125,34 +235,64 @@ class TelegramLinkExtractor:
             logger.error(f"Error getting channel info for {channel_identifier}: {e}")
             return None
 
-    async def process_message(self, message: Message) -> List[Dict[str, Any]]:
+    def process_message(self, message: Message) -> List[LinkHit]:
         links = []
+        text = getattr(message, 'message', None)
+        caption = getattr(message, 'caption', None)
+        has_entities = bool(getattr(message, 'entities', None))
+        has_buttons = bool(getattr(getattr(message, 'reply_markup', None), 'rows', None))
+        # Most messages carry nothing a link could be in
+        if not (text or caption or has_entities or has_buttons):
+            return links
+        # Looked up once and shared by every link found in this message
+        message_id = message.id
+        chat_id = getattr(message, 'chat_id', None)
+        timestamp = datetime.now().isoformat()
         # Main text
-        if getattr(message, 'message', None):
-            links.extend(self.extract_links_from_text(message.message, message.id, getattr(message, 'chat_id', None), context="text"))
+        if text:
+            links.extend(self.extract_links_from_text(text, message_id, chat_id, context="text", timestamp=timestamp))
         # Caption
-        if hasattr(message, 'caption') and getattr(message, 'caption', None):
-            links.extend(self.extract_links_from_text(message.caption, message.id, getattr(message, 'chat_id', None), context="caption"))
+        if caption:
+            links.extend(self.extract_links_from_text(caption, message_id, chat_id, context="caption", timestamp=timestamp))
         # Entities (URLs)
-        links.extend(self.extract_links_from_entities(message))
+        if has_entities:
+            links.extend(self.extract_links_from_entities(message, message_id, chat_id, timestamp))
         # Reply markup (buttons)
-        links.extend(self.extract_links_from_reply_markup(message))
+        if has_buttons:
+            links.extend(self.extract_links_from_reply_markup(message, message_id, chat_id, timestamp))
         # Debug output
         if links:
-            logger.info(f"[DEBUG] Message {message.id}: Found {len(links)} link(s)")
+            logger.info(f"[DEBUG] Message {message_id}: Found {len(links)} link(s)")
         return links
 
+    def _process_batch(self, messages: List[Message]) -> List[List[LinkHit]]:
+        return [self.process_message(message) for message in messages]
+
+    async def _message_producer(self, entity, limit: int, queue: asyncio.Queue):
+        """Fetch messages into the queue, then a None sentinel."""
+        try:
+            async for message in self.client.iter_messages(entity, limit=limit):
+                await queue.put(message)
+        except asyncio.CancelledError:
+            # Cancelled by the consumer, which no longer waits for the sentinel
+            raise
+        except Exception:
+            await queue.put(None)
+            raise
+        await queue.put(None)
+
     async def extract_links_from_channel(
         self, 
         channel_identifier: str, 
         limit: int = 1000,
         save_to_file: bool = True,
-        output_file: str = "extracted_links.json"
+        output_file: str = "extracted_links.json",
+        pretty: bool = False
     ) -> Dict[str, Any]:
         try:
             if not channel_identifier.startswith('@'):
                 channel_identifier = f"@{channel_identifier}"
-            entity = await self.client.get_entity(channel_identifier)
+            entity = await self.get_entity(channel_identifier)
             if not entity:
                 raise ValueError(f"Could not find channel: {channel_identifier}")
             logger.info(f"Starting link extraction from: {getattr(entity, 'title', channel_identifier)}")
@@ -172,23 +312,58 @@ class TelegramLinkExtractor:
                     'unique_links': 0,
                 }
             }
+            # When saving, links go straight to the file and are not kept in results
+            writer = LinkStreamWriter(output_file, pretty) if save_to_file else None
             message_count = 0
             total_links = 0
-            async for message in self.client.iter_messages(entity, limit=limit):
-                message_count += 1
-                message_links = await self.process_message(message)
-                total_links += len(message_links)
-                results['links'].extend(message_links)
-                for link in message_links:
-                    link_type = link['context']
-                    results['statistics']['link_types'][link_type] = results['statistics']['link_types'].get(link_type, 0) + 1
-                if message_count % 100 == 0:
-                    logger.info(f"Processed {message_count} messages, total links so far: {total_links}")
-            results['extraction_info']['total_messages_processed'] = message_count
-            results['extraction_info']['total_links_found'] = total_links
-            results['statistics']['unique_links'] = len({l['link'] for l in results['links']})
-            if save_to_file:
-                self.save_links_to_file(results, output_file)
+            seen_links = set()
+            link_types = Counter()
+            # Extraction runs in a worker thread while the next messages are fetched
+            queue: asyncio.Queue = asyncio.Queue(maxsize=MESSAGE_QUEUE_SIZE)
+            producer = asyncio.ensure_future(self._message_producer(entity, limit, queue))
+            loop = asyncio.get_running_loop()
+            try:
+                finished = False
+                while not finished:
+                    batch = [await queue.get()]
+                    while len(batch) < EXTRACT_BATCH_SIZE and not queue.empty():
+                        batch.append(queue.get_nowait())
+                    if batch[-1] is None:
+                        batch.pop()
+                        finished = True
+                    if not batch:
+                        continue
+                    for message_links in await loop.run_in_executor(None, self._process_batch, batch):
+                        total_links += len(message_links)
+                        for link in message_links:
+                            seen_links.add(link.link)
+                            link_types[link.context] += 1
+                            if writer is not None:
+                                writer.write(link)
+                        if writer is None:
+                            results['links'].extend(message_links)
+                    previous_count = message_count
+                    message_count += len(batch)
+                    if message_count // 100 > previous_count // 100:
+                        logger.info(f"Processed {message_count} messages, total links so far: {total_links}")
+                # Re-raises a failure from fetching
+                await producer
+                results['extraction_info']['total_messages_processed'] = message_count
+                results['extraction_info']['total_links_found'] = total_links
+                results['statistics']['link_types'] = dict(link_types)
+                results['statistics']['unique_links'] = len(seen_links)
+                if writer is not None:
+                    writer.close({
+                        'extraction_info': results['extraction_info'],
+                        'statistics': results['statistics'],
+                    })
+            except BaseException:
+                if writer is not None:
+                    writer.abort()
+                raise
+            finally:
+                if not producer.done():
+                    producer.cancel()
             logger.info(f"Extraction completed: {total_links} links found from {message_count} messages")
             logger.info(f"Unique links found: {results['statistics']['unique_links']}")
             return results
@@ -196,12 +371,12 @@ class TelegramLinkExtractor:
             logger.error(f"Error extracting links from channel {channel_identifier}: {e}")
             raise
 
-    def save_links_to_file(self, results: Dict[str, Any], output_file: str):
+    def save_links_to_file(self, results: Dict[str, Any], output_file: str, pretty: bool = False):
         try:
             output_path = Path(output_file)
             output_path.parent.mkdir(parents=True, exist_ok=True)
-            with open(output_path, 'w', encoding='utf-8') as f:
-                json.dump(results, f, indent=2, ensure_ascii=False, default=str)
+            with open(output_path, 'wb') as f:
+                f.write(dumps(results, pretty))
             logger.info(f"Links saved to: {output_path}")
         except Exception as e:
             logger.error(f"Error saving links to file: {e}")
@@ -2,14 +2,59 @@
 Utility functions for Telegram Media Downloader
 """
 
+import atexit
 import json
 import os
+import pickle
+import queue
+import re
+import threading
 import yaml
+from dataclasses import asdict, is_dataclass
 from pathlib import Path
 from typing import Dict, Any, Optional
 from datetime import datetime
 import hashlib
 
+try:
+    from yaml import CSafeLoader as _YamlLoader
+except ImportError:
+    from yaml import SafeLoader as _YamlLoader
+
+try:
+    import orjson
+except ImportError:  # optional; falls back to the json module
+    orjson = None
+
+def _json_default(obj: Any) -> Any:
+    """Serialize dataclass records as dicts and anything else as a string."""
+    if is_dataclass(obj) and not isinstance(obj, type):
+        return asdict(obj)
+    return str(obj)
+
+def dumps(obj: Any, pretty: bool = False) -> bytes:
+    """Serialize to JSON bytes with orjson when installed; compact unless pretty."""
+    if orjson is not None:
+        return orjson.dumps(obj, default=_json_default, option=orjson.OPT_INDENT_2 if pretty else 0)
+    if pretty:
+        return json.dumps(obj, indent=2, ensure_ascii=False, default=_json_default).encode('utf-8')
+    # ASCII output lets the encoder skip the UTF-8 path
+    return json.dumps(obj, separators=(',', ':'), ensure_ascii=True, default=_json_default).encode('ascii')
+
+# Parsed config.yaml, reused while the file's mtime and size are unchanged
+CONFIG_CACHE_FILE = Path.home() / ".cache" / "tmd" / "config.pkl"
+
+# Metadata for every file in a download folder is appended here, one JSON object per line
+METADATA_FILE_NAME = "metadata.jsonl"
+
+# Characters that are invalid in file names on common file systems
+_SANITIZE_TABLE = str.maketrans({c: '_' for c in '<>:"/\\|?*'})
+
+# Read size for hashing when hashlib.file_digest (Python 3.11+) is unavailable
+HASH_BUFFER_SIZE = 1024 * 1024
+
+_SIZE_NAMES = ("B", "KB", "MB", "GB", "TB")
+
 def load_config(config_path: str = "config.yaml") -> Dict[str, Any]:
     """Load configuration from YAML file."""
     default_config = {
@@ -49,36 +94,79 @@ def load_config(config_path: str = "config.yaml") -> Dict[str, Any]:
     
     try:
         if os.path.exists(config_path):
-            with open(config_path, 'r') as f:
-                config = yaml.safe_load(f)
-                # Merge with defaults for missing keys
-                return merge_configs(default_config, config)
+            config = _load_yaml_cached(config_path)
+            # Merge with defaults for missing keys
+            return _prepare_filters(merge_configs(default_config, config))
         else:
             # Create default config file
             with open(config_path, 'w') as f:
                 yaml.dump(default_config, f, default_flow_style=False)
-            return default_config
+            return _prepare_filters(default_config)
     except Exception as e:
         print(f"Warning: Could not load config file: {e}")
-        return default_config
+        return _prepare_filters(default_config)
+
+def _load_yaml_cached(config_path: str) -> Any:
+    """Parse a YAML file, skipping the parse when the cached copy is still current."""
+    stat = os.stat(config_path)
+    key = (os.path.abspath(config_path), stat.st_mtime_ns, stat.st_size)
+    try:
+        with open(CONFIG_CACHE_FILE, 'rb') as f:
+            cached_key, cached_config = pickle.load(f)
+        if cached_key == key:
+            return cached_config
+    except Exception:
+        pass
+    
+    with open(config_path, 'r') as f:
+        config = yaml.load(f, Loader=_YamlLoader)
+    
+    # The cache is only an optimization; failing to write it is not an error
+    try:
+        CONFIG_CACHE_FILE.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = CONFIG_CACHE_FILE.with_name(f"{CONFIG_CACHE_FILE.name}.{os.getpid()}.tmp")
+        with open(tmp_path, 'wb') as f:
+            pickle.dump((key, config), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, CONFIG_CACHE_FILE)
+    except OSError:
+        pass
+    return config
+
+def _prepare_filters(config: Dict[str, Any]) -> Dict[str, Any]:
+    """Store the lowercased extension filters as sets for should_download_file."""
+    filters = config.setdefault("filters", {})
+    filters["_allowed_set"] = frozenset(ext.lower() for ext in filters.get("allowed_extensions") or [])
+    filters["_excluded_set"] = frozenset(ext.lower() for ext in filters.get("excluded_extensions") or [])
+    return config
 
 def merge_configs(default: Dict[str, Any], user: Dict[str, Any]) -> Dict[str, Any]:
-    """Recursively merge user config with defaults."""
-    result = default.copy()
+    """Merge user config with defaults, section by section."""
+    # The config is two levels deep (section -> scalar settings), so one
+    # dict merge per section replaces the generic recursive walk
+    result = dict(default)
     for key, value in user.items():
-        if key in result and isinstance(result[key], dict) and isinstance(value, dict):
-            result[key] = merge_configs(result[key], value)
+        section = default.get(key)
+        if isinstance(section, dict) and isinstance(value, dict):
+            result[key] = {**section, **value}
         else:
             result[key] = value
     return result
 
 def get_file_hash(file_path: Path) -> str:
     """Calculate SHA256 hash of a file."""
-    hash_sha256 = hashlib.sha256()
     try:
         with open(file_path, "rb") as f:
-            for chunk in iter(lambda: f.read(4096), b""):
-                hash_sha256.update(chunk)
+            if hasattr(hashlib, "file_digest"):
+                return hashlib.file_digest(f, "sha256").hexdigest()
+            hash_sha256 = hashlib.sha256()
+            # Reuse one buffer instead of allocating a bytes object per chunk
+            buffer = bytearray(HASH_BUFFER_SIZE)
+            view = memoryview(buffer)
+            while True:
+                n = f.readinto(buffer)
+                if not n:
+                    break
+                hash_sha256.update(view[:n])
         return hash_sha256.hexdigest()
     except Exception:
         return ""
@@ -87,25 +175,18 @@ def format_file_size(size_bytes: int) -> str:
     """Format file size in human readable format."""
     if size_bytes == 0:
         return "0B"
+    if size_bytes < 1024:
+        # Also covers fractional and negative sizes, which stay in bytes
+        return f"{float(size_bytes):.1f}B"
     
-    size_names = ["B", "KB", "MB", "GB", "TB"]
-    i = 0
-    size_float = float(size_bytes)
-    while size_float >= 1024 and i < len(size_names) - 1:
-        size_float /= 1024.0
-        i += 1
-    
-    return f"{size_float:.1f}{size_names[i]}"
+    # Each unit is 2**10 times the previous one, so the bit length picks it directly
+    i = min((int(size_bytes).bit_length() - 1) // 10, len(_SIZE_NAMES) - 1)
+    return f"{size_bytes / (1 << (i * 10)):.1f}{_SIZE_NAMES[i]}"
 
 def sanitize_filename(filename: str) -> str:
     """Sanitize filename for safe file system usage."""
-    # Remove or replace invalid characters
-    invalid_chars = '<>:"/\\|?*'
-    for char in invalid_chars:
-        filename = filename.replace(char, '_')
-    
-    # Remove leading/trailing spaces and dots
-    filename = filename.strip(' .')
+    # Replace invalid characters, then remove leading/trailing spaces and dots
+    filename = filename.translate(_SANITIZE_TABLE).strip(' .')
     
     # Ensure filename is not empty
     if not filename:
@@ -143,12 +224,63 @@ def save_metadata(message, file_path: Path, config: Dict[str, Any]):
         "downloaded_at": datetime.now().isoformat()
     }
     
-    metadata_path = file_path.with_suffix(file_path.suffix + ".json")
+    # Written by the background writer so downloads never wait on file I/O.
+    # Queued under the lock so the record can't land behind flush_metadata()'s
+    # sentinel, where no writer would ever read it
+    with _metadata_thread_lock:
+        _start_metadata_writer()
+        _metadata_queue.put((file_path.parent / METADATA_FILE_NAME, metadata))
+
+_metadata_queue: "queue.Queue" = queue.Queue()
+_metadata_thread: Optional[threading.Thread] = None
+_metadata_thread_lock = threading.Lock()
+
+def _start_metadata_writer():
+    """Start the writer thread if it is not running; call with _metadata_thread_lock held."""
+    global _metadata_thread
+    if _metadata_thread is None or not _metadata_thread.is_alive():
+        _metadata_thread = threading.Thread(target=_write_metadata, name="metadata-writer", daemon=True)
+        _metadata_thread.start()
+
+def _write_metadata():
+    """Append queued metadata records to their folder's metadata file until a None sentinel."""
+    files = {}
     try:
-        with open(metadata_path, 'w') as f:
-            json.dump(metadata, f, indent=2, default=str)
-    except Exception as e:
-        print(f"Warning: Could not save metadata for {file_path}: {e}")
+        while True:
+            item = _metadata_queue.get()
+            if item is None:
+                return
+            metadata_path, metadata = item
+            try:
+                f = files.get(metadata_path)
+                if f is None:
+                    f = files[metadata_path] = open(metadata_path, 'ab')
+                f.write(dumps(metadata) + b"\n")
+            except Exception as e:
+                print(f"Warning: Could not save metadata to {metadata_path}: {e}")
+            # Hand the data to the OS whenever the queue runs dry
+            if _metadata_queue.empty():
+                for f in files.values():
+                    f.flush()
+    finally:
+        for f in files.values():
+            try:
+                f.flush()
+                os.fsync(f.fileno())
+            finally:
+                f.close()
+
+def flush_metadata():
+    """Write out all queued metadata and sync it to disk."""
+    global _metadata_thread
+    # Held throughout so no new writer can start and take the sentinel
+    with _metadata_thread_lock:
+        if _metadata_thread is not None and _metadata_thread.is_alive():
+            _metadata_queue.put(None)
+            _metadata_thread.join()
+        _metadata_thread = None
+
+atexit.register(flush_metadata)
 
 def should_download_file(file_size: int, file_extension: str, config: Dict[str, Any]) -> bool:
     """Check if file should be downloaded based on filters."""
@@ -164,31 +296,41 @@ def should_download_file(file_size: int, file_extension: str, config: Dict[str,
     if file_size > max_size_mb * 1024 * 1024:
         return False
     
-    # Check extension filters
-    allowed_extensions = filters.get("allowed_extensions", [])
-    excluded_extensions = filters.get("excluded_extensions", [])
+    # Check extension filters; configs not built by load_config get their sets here
+    if "_allowed_set" not in filters:
+        filters = _prepare_filters({"filters": dict(filters)})["filters"]
+    allowed = filters["_allowed_set"]
+    file_extension = file_extension.lower()
     
-    if allowed_extensions and file_extension.lower() not in [ext.lower() for ext in allowed_extensions]:
+    if allowed and file_extension not in allowed:
         return False
     
-    if file_extension.lower() in [ext.lower() for ext in excluded_extensions]:
+    if file_extension in filters["_excluded_set"]:
         return False
     
     return True
 
 def get_file_extension(filename: str) -> str:
     """Extract file extension from filename."""
-    return Path(filename).suffix.lower()
+    # Same rule as Path.suffix without building a Path for every file
+    name = os.path.basename(filename)
+    i = name.rfind('.')
+    return name[i:].lower() if 0 < i < len(name) - 1 else ""
 
 def create_backup_filename(file_path: Path) -> Path:
     """Create a backup filename to avoid overwriting existing files."""
-    counter = 1
-    original_path = file_path
+    if not file_path.exists():
+        return file_path
     
-    while file_path.exists():
-        stem = original_path.stem
-        suffix = original_path.suffix
-        file_path = original_path.parent / f"{stem}_{counter}{suffix}"
-        counter += 1
+    # One directory listing instead of a stat per existing backup
+    stem = file_path.stem
+    suffix = file_path.suffix
+    backup_re = re.compile(rf"{re.escape(stem)}_(\d+){re.escape(suffix)}")
+    counter = 0
+    with os.scandir(file_path.parent) as entries:
+        for entry in entries:
+            match = backup_re.fullmatch(entry.name)
+            if match:
+                counter = max(counter, int(match.group(1)))
     
-    return file_path 
\ No newline at end of file
+    return file_path.parent / f"{stem}_{counter + 1}{suffix}" 
\ No newline at end of file